@@ -1,17 +1,33 @@
 import sys
-import requests
-from web3 import Web3
-import json
+import logging
+import logging.handlers
+import queue
+import atexit
+import asyncio
+import httpx
+from web3 import Web3, AsyncWeb3, HTTPProvider, AsyncHTTPProvider, WebsocketProviderV2
+from eth_utils.abi import collapse_if_tuple
+from eth_keys.backends import get_backend
+from eth_abi import encode
+import orjson
+from decimal import Decimal
+from dataclasses import dataclass, field
 import os
 from dotenv import load_dotenv
 
-from web3.middleware import geth_poa_middleware
+from web3.middleware import geth_poa_middleware, async_geth_poa_middleware
+from web3.exceptions import TimeExhausted, TransactionNotFound
 
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(BASEDIR, '../.env'))
 
 ABI_FOLDER_PATH = "./abis"
 RPC = os.getenv('BOT_RPC')
+# Optional websocket endpoint, when set the bot runs on every new block instead of once
+WS_RPC = os.getenv('BOT_WS_RPC')
+WS_RECONNECT_DELAY = 5
+# Seconds between checks of a liquidation that wasn't mined before the receipt wait timed out
+PENDING_TX_POLL_INTERVAL = 5
 ADDRESS_PROVIDER_CONTRACT_ADDRESS = os.getenv('BOT_ADDRESS_PROVIDER_CONTRACT_ADDRESS')
 
 LIQUIDATOR_WALLET_ADDRESS = os.getenv('BOT_OPERATING_WALLET_ADDRESS')
@@ -19,63 +35,163 @@ LIQUIDATOR_WALLET_PRIVATE_KEY = os.getenv('BOT_OPERATING_WALLET_PRIVATE_KEY')
 
 API_URL = os.getenv('BOT_API_URL')
 
-f = open(f'{ABI_FOLDER_PATH}/addressProviderABI.json')
-addressProviderABI=json.load(f)
-f.close()
+# Records are only queued by the bot, a background listener thread formats and writes them to stdout
+logger = logging.getLogger('meld.liq')
+logger.setLevel(os.getenv('BOT_LOG_LEVEL', 'INFO'))
+logQueue = queue.SimpleQueue()
+logHandler = logging.StreamHandler(sys.stdout)
+logHandler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+logListener = logging.handlers.QueueListener(logQueue, logHandler)
+logListener.start()
+# Stopping the listener writes any record still in the queue before exiting
+atexit.register(logListener.stop)
+logger.addHandler(logging.handlers.QueueHandler(logQueue))
+
+# Gas settings of liquidation transactions, the gas limit is the simulated gas plus some headroom
+GAS_LIMIT_HEADROOM_PERCENT = 20
+PRIORITY_FEE_PERCENTILE = 50
+
+# Powers of ten for every token decimals value, so token amounts are scaled without recomputing them
+SCALES = tuple(10**i for i in range(31))
+
+# Canonical Multicall3 deployment, override if the chain uses a different address
+MULTICALL3_ADDRESS = os.getenv('BOT_MULTICALL3_ADDRESS', '0xcA11bde05977b3631167028862bE2a173976CA11')
+
+# Shared HTTP/2 clients, all API and RPC requests are multiplexed over kept-alive connections
+HTTPX_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+# Large enough pool for concurrent RPC calls, and idle connections are kept long enough to be reused by the next run
+HTTPX_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0)
+HTTPX_CLIENT = httpx.Client(
+    timeout=HTTPX_TIMEOUT,
+    transport=httpx.HTTPTransport(http2=True, retries=3, limits=HTTPX_LIMITS),
+)
+ASYNC_HTTPX_CLIENT = httpx.AsyncClient(
+    timeout=HTTPX_TIMEOUT,
+    transport=httpx.AsyncHTTPTransport(http2=True, retries=3, limits=HTTPX_LIMITS),
+)
+
+
+class HTTPXProvider(HTTPProvider):
+    # web3 HTTP provider sending its JSON-RPC requests through the shared HTTP/2 client
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        response = HTTPX_CLIENT.post(self.endpoint_uri, content=request_data, headers=self.get_request_headers())
+        response.raise_for_status()
+        return self.decode_rpc_response(response.content)
+
+
+class AsyncHTTPXProvider(AsyncHTTPProvider):
+    # Async counterpart of HTTPXProvider
+    async def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        response = await ASYNC_HTTPX_CLIENT.post(self.endpoint_uri, content=request_data, headers=self.get_request_headers())
+        response.raise_for_status()
+        return self.decode_rpc_response(response.content)
+
+
+def loadABI(name):
+    with open(f'{ABI_FOLDER_PATH}/{name}.json', 'rb') as f:
+        return orjson.loads(f.read())
+
+addressProviderABI = loadABI('addressProviderABI')
+lendingPoolABI = loadABI('lendingPoolABI')
+dataProviderABI = loadABI('dataProviderABI')
+genericABI = loadABI('genericABI')
+liquidateLoanABI = loadABI('liquidateLoanABI')
+multicall3ABI = loadABI('multicall3ABI')
+
+w3 = Web3(HTTPXProvider(RPC))
+w3.middleware_onion.inject(geth_poa_middleware, layer=0)
 
-f = open(f'{ABI_FOLDER_PATH}/lendingPoolABI.json')
-lendingPoolABI=json.load(f)
-f.close()
+# Async provider used by the liquidation logic so independent RPC calls can run concurrently
+aw3 = AsyncWeb3(AsyncHTTPXProvider(RPC))
+aw3.middleware_onion.inject(async_geth_poa_middleware, layer=0)
 
-f = open(f'{ABI_FOLDER_PATH}/dataProviderABI.json')
-dataProviderABI=json.load(f)
-f.close()
+def encodeMulticall(calls):
+    # Encode a list of (contract, functionName, args) reads as aggregate3 calls
+    return [
+        (contract.address, False, contract.encodeABI(fn_name=functionName, args=args))
+        for contract, functionName, args in calls
+    ]
 
-f = open(f'{ABI_FOLDER_PATH}/genericABI.json')
-genericABI=json.load(f)
-f.close()
 
-f = open(f'{ABI_FOLDER_PATH}/liquidateLoanABI.json')
-liquidateLoanABI=json.load(f)
-f.close()
+def decodeMulticall(calls, aggregateResults):
+    results = []
+    for (contract, functionName, _), (_, returnData) in zip(calls, aggregateResults):
+        outputTypes = [collapse_if_tuple(output) for output in contract.get_function_by_name(functionName).abi['outputs']]
+        # eth_abi returns lowercase addresses, checksum them like the direct contract calls do
+        decoded = [
+            Web3.to_checksum_address(value) if outputType == 'address' else value
+            for outputType, value in zip(outputTypes, w3.codec.decode(outputTypes, returnData))
+        ]
+        results.append(decoded[0] if len(decoded) == 1 else decoded)
+    return results
+
+
+async def multicall(calls):
+    # Batch a list of (contract, functionName, args) reads into a single aggregate3 eth_call
+    return decodeMulticall(calls, await multicallContract.functions.aggregate3(encodeMulticall(calls)).call())
 
-w3 = Web3(Web3.HTTPProvider(RPC))
-w3.middleware_onion.inject(geth_poa_middleware, layer=0)
 
 # Get contract addresses
 url = f"{API_URL}/v1/lending/global"
-response = requests.get(url)
+response = HTTPX_CLIENT.get(url)
 
 if response.status_code == 200:
-    data = response.json()
+    data = orjson.loads(response.content)
     ADDRESS_PROVIDER_CONTRACT_ADDRESS = data['addresses']['lendingAddressesProvider']
 else:
     # Request failed
-    print("Failed to fetch global data")
-    print(response.json())
+    logger.error("Failed to fetch global data")
+    logger.error("%s", response.text)
     # exit
     sys.exit()
 
 addressProviderContract = w3.eth.contract(address=Web3.to_checksum_address(ADDRESS_PROVIDER_CONTRACT_ADDRESS), abi=addressProviderABI)
 
-lendingPoolContractAddress = addressProviderContract.functions.getLendingPool().call()
-dataProviderContractAddress = addressProviderContract.functions.getProtocolDataProvider().call()
-
-lendingPoolContract = w3.eth.contract(address=Web3.to_checksum_address(lendingPoolContractAddress), abi=lendingPoolABI)
-dataProviderContract = w3.eth.contract(address=Web3.to_checksum_address(dataProviderContractAddress), abi=dataProviderABI)
-
-liquidationLoanContract = w3.eth.contract(address=Web3.to_checksum_address(os.getenv('LIQUIDATION_CONTRACT_ADDRESS')), abi=liquidateLoanABI)
-
-print("===================== STARTING LIQUIDATION BOT ============================")
-print("============= CONFIG PARAMETERS ==============")
-print("Using RPC: ", RPC)
-print("Address provider: ", ADDRESS_PROVIDER_CONTRACT_ADDRESS)
-print("Lending Pool Address: ", lendingPoolContractAddress)
-print("Data Provider Address: ", dataProviderContractAddress)
-print("Using bot deployed at address: ", os.getenv('LIQUIDATION_CONTRACT_ADDRESS'))
-print("=========== END CONFIG PARAMETERS ============")
-
-CHAIN_ID = w3.eth.chain_id
+syncMulticallContract = w3.eth.contract(address=Web3.to_checksum_address(MULTICALL3_ADDRESS), abi=multicall3ABI)
+
+# Every on-chain read goes through Multicall3, fail early with a clear message if it isn't deployed on this chain
+if len(w3.eth.get_code(syncMulticallContract.address)) == 0:
+    raise RuntimeError(f"No Multicall3 contract deployed at {MULTICALL3_ADDRESS}, set BOT_MULTICALL3_ADDRESS to its address on this chain")
+
+# Read all the startup values in a single RPC round-trip
+startupCalls = [
+    (addressProviderContract, 'getLendingPool', []),
+    (addressProviderContract, 'getProtocolDataProvider', []),
+    (syncMulticallContract, 'getChainId', []),
+]
+lendingPoolContractAddress, dataProviderContractAddress, CHAIN_ID = decodeMulticall(
+    startupCalls,
+    syncMulticallContract.functions.aggregate3(encodeMulticall(startupCalls)).call(),
+)
+
+lendingPoolContract = aw3.eth.contract(address=Web3.to_checksum_address(lendingPoolContractAddress), abi=lendingPoolABI)
+dataProviderContract = aw3.eth.contract(address=Web3.to_checksum_address(dataProviderContractAddress), abi=dataProviderABI)
+
+liquidationLoanContract = aw3.eth.contract(address=Web3.to_checksum_address(os.getenv('LIQUIDATION_CONTRACT_ADDRESS')), abi=liquidateLoanABI)
+
+multicallContract = aw3.eth.contract(address=Web3.to_checksum_address(MULTICALL3_ADDRESS), abi=multicall3ABI)
+
+# liquidateUserWithFlashLoan calldata is built by hand, only the arguments are encoded for each liquidation
+LIQUIDATE_SELECTOR = Web3.keccak(text='liquidateUserWithFlashLoan(address,uint256,address,address,address[])')[:4]
+LIQUIDATE_ARGUMENT_TYPES = ['address', 'uint256', 'address', 'address', 'address[]']
+
+# The private key is parsed once, every liquidation is signed with this account
+ACCOUNT = w3.eth.account.from_key(LIQUIDATOR_WALLET_PRIVATE_KEY)
+if LIQUIDATOR_WALLET_ADDRESS and ACCOUNT.address != Web3.to_checksum_address(LIQUIDATOR_WALLET_ADDRESS):
+    raise RuntimeError(f"BOT_OPERATING_WALLET_PRIVATE_KEY belongs to {ACCOUNT.address}, not to BOT_OPERATING_WALLET_ADDRESS {LIQUIDATOR_WALLET_ADDRESS}")
+
+logger.info("===================== STARTING LIQUIDATION BOT ============================")
+logger.info("============= CONFIG PARAMETERS ==============")
+logger.info("Using RPC: %s", RPC)
+logger.info("Address provider: %s", ADDRESS_PROVIDER_CONTRACT_ADDRESS)
+logger.info("Lending Pool Address: %s", lendingPoolContractAddress)
+logger.info("Data Provider Address: %s", dataProviderContractAddress)
+logger.info("Using bot deployed at address: %s", os.getenv('LIQUIDATION_CONTRACT_ADDRESS'))
+logger.info("Multicall3 address: %s", MULTICALL3_ADDRESS)
+logger.info("Signing backend: %s", type(get_backend()).__name__)
+logger.info("=========== END CONFIG PARAMETERS ============")
 
 # Convenience class for debugging
 class UserAccountData:
@@ -88,68 +204,106 @@ class UserAccountData:
         self.healthFactor = blockchainArray[5]
 
     def __str__(self):
-        return (f"Supplied (USD): {self.suppliedAmount/pow(10,18)}\n"
-        f"Borrowed (USD): {self.borrowedAmount/pow(10,18)}\n"
-        f"Available to borrow (USD): {self.availableToBorrow/pow(10,18)}\n"
-        f"Current liquidation threshold: {self.currentLiquidationThreshold/100}%\n"
-        f"LTV: {self.ltv/100}%\n"
-        f"Health factor: {self.healthFactor/pow(10,18)}"
+        return (f"Supplied (USD): {Decimal(self.suppliedAmount)/SCALES[18]}\n"
+        f"Borrowed (USD): {Decimal(self.borrowedAmount)/SCALES[18]}\n"
+        f"Available to borrow (USD): {Decimal(self.availableToBorrow)/SCALES[18]}\n"
+        f"Current liquidation threshold: {Decimal(self.currentLiquidationThreshold)/100}%\n"
+        f"LTV: {Decimal(self.ltv)/100}%\n"
+        f"Health factor: {Decimal(self.healthFactor)/SCALES[18]}"
         )
 
 
 
-def getUserAccountData(userAddress):
-    return lendingPoolContract.functions.getUserAccountData(userAddress).call()
+# ERC20 bindings are built once per token, building a contract walks the whole ABI
+erc20Contracts = {}
+
+def erc20(tokenAddress):
+    if tokenAddress not in erc20Contracts:
+        erc20Contracts[tokenAddress] = aw3.eth.contract(address=tokenAddress, abi=genericABI)
+    return erc20Contracts[tokenAddress]
+
 
+# Token decimals never change, so they are cached for the whole lifetime of the bot
+decimalsCache = {}
 
-def getLiquidatablePositions():
+
+async def getUserAccountData(userAddress):
+    return await lendingPoolContract.functions.getUserAccountData(userAddress).call()
+
+
+
+
+async def getLiquidatablePositions():
     url = f"{API_URL}/v1/lending/user/liquidatable"
-    response = requests.get(url)
+    response = await ASYNC_HTTPX_CLIENT.get(url)
     liquidatablePositions = []
     
     if response.status_code == 200:
-        data = response.json()
+        data = orjson.loads(response.content)
 
 
         for liquidatablePositionData in data:
-            liquidatablePositions.append(LiquidatablePosition(liquidatablePositionData))
+            liquidatablePositions.append(LiquidatablePosition.fromApiData(liquidatablePositionData))
     else:
         # Request failed
-        print("Failed to make REQUEST to get liquidatable positions")
-        print(response.json())
-        # exit
-        sys.exit()
+        logger.error("Failed to make REQUEST to get liquidatable positions")
+        logger.error("%s", response.text)
+        raise RuntimeError(f"Liquidatable positions request failed with status {response.status_code}")
 
     return liquidatablePositions
 
 
 
+@dataclass(slots=True, frozen=True)
 class LiquidatablePosition:
-    def __init__(self, data):
-        self.address = data['address']
-        self.riskFactor = data['riskFactor']
-        self.borrowedAssets = []
-        for borrowedAsset in data['borrowedAssets']:
-            self.borrowedAssets.append(
+    address: str
+    riskFactor: str
+    borrowedAssets: list
+    supliedAssets: list
+    addressChecksum: str = field(init=False)
+
+    def __post_init__(self):
+        # Frozen dataclass, derived fields have to be set through object.__setattr__
+        object.__setattr__(self, 'addressChecksum', Web3.to_checksum_address(self.address))
+
+    @classmethod
+    def fromApiData(cls, data):
+        # Amounts used by the liquidation math are parsed once here instead of on every use
+        return cls(
+            address = data['address'],
+            riskFactor = data['riskFactor'],
+            borrowedAssets = [
                 BorrowedAsset(
-                    contract=borrowedAsset['contract'],
-                    liquidationPrice=borrowedAsset['liquidationPrice'],
-                    stableRate=borrowedAsset['stable'],
-                    variableRate=borrowedAsset['variable']
+                    contract = borrowedAsset['contract'],
+                    liquidationPrice = borrowedAsset['liquidationPrice'],
+                    stableRate = StableRate(
+                        fiatAmount = borrowedAsset['stable']['fiatAmount'],
+                        originalBorrowedAmount = borrowedAsset['stable']['originalBorrowedAmount'],
+                        rate = borrowedAsset['stable']['rate'],
+                        totalBorrowedAmount = borrowedAsset['stable']['totalBorrowedAmount']
+                    ),
+                    variableRate = VariableRate(
+                        fiatAmount = Decimal(str(borrowedAsset['variable']['fiatAmount'])),
+                        originalBorrowedAmount = borrowedAsset['variable']['originalBorrowedAmount'],
+                        totalBorrowedAmount = int(borrowedAsset['variable']['totalBorrowedAmount'])
+                    )
                 )
-            )
-        self.supliedAssets = []
-        for supliedAsset in data['supliedAssets']:
-            self.supliedAssets.append(
+                for borrowedAsset in data['borrowedAssets']
+            ],
+            supliedAssets = [
                 SuppliedAsset(
                     contract = supliedAsset['contract'],
-                    fiatAmount = supliedAsset['fiatAmount'],
+                    fiatAmount = fiatAmount,
                     isCollateral = supliedAsset['isCollateral'],
                     liquidationPrice = supliedAsset['liquidationPrice'],
                     originalSuppliedAmount = supliedAsset['originalSuppliedAmount'],
-                    totalSuppliedAmount = supliedAsset['totalSuppliedAmount']
+                    totalSuppliedAmount = int(supliedAsset['totalSuppliedAmount'])
                 )
-            )
+                for supliedAsset in data['supliedAssets']
+                # Only collaterals worth at least 1 USD can be liquidated
+                if supliedAsset['isCollateral'] and (fiatAmount := Decimal(str(supliedAsset['fiatAmount']))) >= 1
+            ]
+        )
 
     def __str__(self):
         borrowed_assets_str = "\n".join([str(asset) for asset in self.borrowedAssets])
@@ -157,177 +311,416 @@ class LiquidatablePosition:
         return f"Address: {self.address}\n\nRisk Factor: {self.riskFactor}\n\nBorrowed Assets:\n{borrowed_assets_str}\n\nSupplied Assets:\n{supplied_assets_str}\n---------------------------------------------------------------"
     
 
+@dataclass(slots=True, frozen=True)
 class BorrowedAsset:
-    def __init__(self, contract, liquidationPrice, stableRate, variableRate):
-        self.contract = contract
-        self.liquidationPrice = liquidationPrice
-        self.stableRate = StableRate(
-            fiatAmount = stableRate['fiatAmount'], 
-            originalBorrowedAmount = stableRate['originalBorrowedAmount'], 
-            rate = stableRate['rate'], 
-            totalBorrowedAmount = stableRate['totalBorrowedAmount']
-        )
-        self.variableRate = VariableRate (
-            fiatAmount = variableRate['fiatAmount'], 
-            originalBorrowedAmount = variableRate['originalBorrowedAmount'], 
-            totalBorrowedAmount = variableRate['totalBorrowedAmount']
-        )
+    contract: str
+    liquidationPrice: str
+    stableRate: 'StableRate'
+    variableRate: 'VariableRate'
+    contractChecksum: str = field(init=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'contractChecksum', Web3.to_checksum_address(self.contract))
         
     def __str__(self):
         return f"\tContract: {self.contract}\n\tLiquidation Price: {self.liquidationPrice}\n\tStable Rate: {self.stableRate}\n\tVariable Rate: {self.variableRate}"
 
+@dataclass(slots=True, frozen=True)
 class SuppliedAsset:
-    def __init__(self, contract, fiatAmount, isCollateral, liquidationPrice, originalSuppliedAmount, totalSuppliedAmount):
-        self.contract = contract
-        self.fiatAmount = fiatAmount
-        self.isCollateral = isCollateral
-        self.liquidationPrice = liquidationPrice
-        self.originalSuppliedAmount = originalSuppliedAmount
-        self.totalSuppliedAmount = totalSuppliedAmount
+    contract: str
+    fiatAmount: Decimal
+    isCollateral: bool
+    liquidationPrice: str
+    originalSuppliedAmount: str
+    totalSuppliedAmount: int
+    contractChecksum: str = field(init=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'contractChecksum', Web3.to_checksum_address(self.contract))
         
     def __str__(self):
         return f"\tContract: {self.contract}\n\tFiat Amount: {self.fiatAmount}\n\tIs Collateral: {self.isCollateral}\n\tLiquidation Price: {self.liquidationPrice}\n\tOriginal Supplied Amount: {self.originalSuppliedAmount}\n\tTotal Supplied Amount: {self.totalSuppliedAmount}\n"
 
+@dataclass(slots=True, frozen=True)
 class StableRate:
-    def __init__(self, fiatAmount, originalBorrowedAmount, rate, totalBorrowedAmount):
-        self.fiatAmount = fiatAmount
-        self.originalBorrowedAmount = originalBorrowedAmount
-        self.rate = rate
-        self.totalBorrowedAmount = totalBorrowedAmount
+    fiatAmount: str
+    originalBorrowedAmount: str
+    rate: str
+    totalBorrowedAmount: str
 
     def __str__(self):
         return f"\n\t\tFiat Amount: {self.fiatAmount}\n\t\tOriginal Borrowed Amount: {self.originalBorrowedAmount}\n\t\tRate: {self.rate}\n\t\tTotal Borrowed Amount: {self.totalBorrowedAmount}"
 
-class VariableRate: 
-    def __init__(self, fiatAmount, originalBorrowedAmount, totalBorrowedAmount):
-        self.fiatAmount = fiatAmount
-        self.originalBorrowedAmount = originalBorrowedAmount
-        self.totalBorrowedAmount = totalBorrowedAmount
+@dataclass(slots=True, frozen=True)
+class VariableRate:
+    fiatAmount: Decimal
+    originalBorrowedAmount: str
+    totalBorrowedAmount: int
 
     def __str__(self):
         return f"\t\tFiat Amount: {self.fiatAmount}\n\t\tOriginal Borrowed Amount: {self.originalBorrowedAmount}\n\t\tTotal Borrowed Amount: {self.totalBorrowedAmount}"
 
 
-def liquidate(collateralAddress, debtAddress, pk, caller, walletToLiquidateAddress, debtToCover):
-    print(f"Liquidating user: {walletToLiquidateAddress}")
-    print(f"Collateral: {collateralAddress}")
-    print(f"Debt: {debtAddress}")
-    print(f"Debt to cover: {debtToCover}")
-
-    transaction = liquidationLoanContract.functions.liquidateUserWithFlashLoan(
-            Web3.to_checksum_address(debtAddress),
-            debtToCover,
-            Web3.to_checksum_address(collateralAddress), 
-            Web3.to_checksum_address(walletToLiquidateAddress),
-            [Web3.to_checksum_address(collateralAddress), Web3.to_checksum_address(debtAddress)],
-        ).build_transaction({
-            'chainId': CHAIN_ID,
-            'from': caller,
-            'nonce': w3.eth.get_transaction_count(caller),
-        })
-    signed_txn = w3.eth.account.sign_transaction(transaction, private_key=pk)
-    tx_hash = w3.to_hex(w3.keccak(signed_txn.rawTransaction))
-    w3.eth.send_raw_transaction(signed_txn.rawTransaction)
-    receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
-    print(f"TX hash: {receipt['transactionHash'].hex()}")
-
-
-def trigger_logic():
-    liquidatablePositions = getLiquidatablePositions()
+async def getGasFees():
+    # Single eth_feeHistory call giving the next block base fee and a recent priority fee
+    feeHistory = await aw3.eth.fee_history(1, 'latest', [PRIORITY_FEE_PERCENTILE])
+    maxPriorityFeePerGas = feeHistory['reward'][0][0]
+    maxFeePerGas = 2 * feeHistory['baseFeePerGas'][-1] + maxPriorityFeePerGas
+    return maxFeePerGas, maxPriorityFeePerGas
+
+
+class NonceTracker:
+    # Hands out consecutive nonces to concurrent submissions of the liquidator wallet, across runs
+    def __init__(self):
+        # None until the nonce is read from the node, and again whenever it has to be resynced
+        self.nonce = None
+        self.lock = asyncio.Lock()
+
+
+nonceTracker = NonceTracker()
+
+# Positions with a liquidation still waiting to be mined, later runs skip them to avoid liquidating them twice
+liquidationsInProgress = set()
+
+
+def encodeLiquidation(collateralAddress, debtAddress, walletToLiquidateAddress, debtToCover):
+    swapPath = [collateralAddress, debtAddress]
+    return LIQUIDATE_SELECTOR + encode(
+        LIQUIDATE_ARGUMENT_TYPES,
+        [debtAddress, debtToCover, collateralAddress, walletToLiquidateAddress, swapPath],
+    )
+
+
+async def simulate_liquidation(data):
+    # eth_estimateGas doubles as a dry run, it raises if the liquidation would revert (e.g. not enough profit)
+    estimatedGas = await aw3.eth.estimate_gas({
+        'from': ACCOUNT.address,
+        'to': liquidationLoanContract.address,
+        'data': data,
+        'value': 0,
+    })
+    return estimatedGas * (100 + GAS_LIMIT_HEADROOM_PERCENT) // 100
+
+
+async def simulate_position(liquidatablePosition, candidates):
+    # Simulates all the candidates of a position concurrently and keeps the ones that would succeed, in their original order
+    encodedCandidates = [
+        (collateralAddress, debtAddress, debtToCover, encodeLiquidation(collateralAddress, debtAddress, liquidatablePosition.addressChecksum, debtToCover))
+        for collateralAddress, debtAddress, debtToCover in candidates
+    ]
+    gasLimits = await asyncio.gather(
+        *(simulate_liquidation(data) for _, _, _, data in encodedCandidates),
+        return_exceptions=True,
+    )
+    simulatedCandidates = []
+    for (collateralAddress, debtAddress, debtToCover, data), gas in zip(encodedCandidates, gasLimits):
+        if isinstance(gas, Exception):
+            logger.info("Liquidation of user %s with collateral %s and debt %s would revert, skipping: %s", liquidatablePosition.address, collateralAddress, debtAddress, gas)
+            continue
+        simulatedCandidates.append((collateralAddress, debtAddress, debtToCover, data, gas))
+    return simulatedCandidates
+
+
+async def submit_liquidation(collateralAddress, debtAddress, walletToLiquidateAddress, debtToCover, data, gas, maxFeePerGas, maxPriorityFeePerGas):
+    logger.info("Liquidating user: %s", walletToLiquidateAddress)
+    logger.info("Collateral: %s", collateralAddress)
+    logger.info("Debt: %s", debtAddress)
+    logger.info("Debt to cover: %s", debtToCover)
+
+    # Only one submission at a time can take a nonce, sign and broadcast so nonces never collide
+    async with nonceTracker.lock:
+        try:
+            if nonceTracker.nonce is None:
+                nonceTracker.nonce = await aw3.eth.get_transaction_count(ACCOUNT.address, 'pending')
+            transaction = {
+                'to': liquidationLoanContract.address,
+                'data': data,
+                'value': 0,
+                'chainId': CHAIN_ID,
+                'nonce': nonceTracker.nonce,
+                'gas': gas,
+                'maxFeePerGas': maxFeePerGas,
+                'maxPriorityFeePerGas': maxPriorityFeePerGas,
+            }
+            signed_txn = ACCOUNT.sign_transaction(transaction)
+            tx_hash = signed_txn.hash
+            nonce = nonceTracker.nonce
+            await aw3.eth.send_raw_transaction(signed_txn.rawTransaction)
+            nonceTracker.nonce += 1
+        except Exception:
+            # The transaction may or may not have been sent, resync the local nonce with the node on next use
+            nonceTracker.nonce = None
+            raise
+
+    logger.info("TX hash: %s", tx_hash.hex())
+    return tx_hash, nonce
+
+
+async def submit_position_liquidation(liquidatablePosition, simulatedCandidates, maxFeePerGas, maxPriorityFeePerGas):
+    # Submits the first candidate that gets broadcast, returns its tx hash and nonce (None if all of them fail) and the candidates left to try
+    for index, (collateralAddress, debtAddress, debtToCover, data, gas) in enumerate(simulatedCandidates):
+        try:
+            txHash, nonce = await submit_liquidation(
+                collateralAddress = collateralAddress, 
+                debtAddress = debtAddress,
+                walletToLiquidateAddress = liquidatablePosition.addressChecksum,
+                debtToCover = debtToCover,
+                data = data,
+                gas = gas,
+                maxFeePerGas = maxFeePerGas,
+                maxPriorityFeePerGas = maxPriorityFeePerGas,
+            )
+            return txHash, nonce, simulatedCandidates[index + 1:]
+        except Exception as e:
+            logger.error("!!!!!! Failed to liquidate user !!!!!!")
+            logger.error("%s", e)
+    return None, None, []
+
+
+async def wait_nonce_released(txHash, nonce):
+    # Returns once the nonce of a liquidation that wasn't mined in time is consumed on-chain, or the node dropped the transaction
+    while True:
+        try:
+            if await aw3.eth.get_transaction_count(ACCOUNT.address) > nonce:
+                return
+            await aw3.eth.get_transaction(txHash)
+        except TransactionNotFound:
+            return
+        except Exception as e:
+            logger.error("Failed to check pending liquidation %s: %s", txHash.hex(), e)
+        await asyncio.sleep(PENDING_TX_POLL_INTERVAL)
+
+
+async def follow_position_liquidation(liquidatablePosition, txHash, nonce, remainingCandidates):
+    # Waits for the liquidation to be mined, moving to the next candidate when it reverts on-chain
+    try:
+        while txHash is not None:
+            receipt = await aw3.eth.wait_for_transaction_receipt(txHash, poll_latency=0.1)
+            if receipt['status'] == 1:
+                logger.info("Succesfully liquidated user: %s", liquidatablePosition.address)
+                return
+
+            logger.error("!!!!!! Liquidation of user %s reverted, trying the next candidate !!!!!!", liquidatablePosition.address)
+            logger.error("TX hash: %s", txHash.hex())
+            # The revert means the state changed since the simulation, simulate the remaining candidates and price gas again
+            remainingCandidates = await simulate_position(
+                liquidatablePosition,
+                [(collateralAddress, debtAddress, debtToCover) for collateralAddress, debtAddress, debtToCover, _, _ in remainingCandidates],
+            )
+            if len(remainingCandidates) == 0:
+                break
+            maxFeePerGas, maxPriorityFeePerGas = await getGasFees()
+            txHash, nonce, remainingCandidates = await submit_position_liquidation(liquidatablePosition, remainingCandidates, maxFeePerGas, maxPriorityFeePerGas)
 
-    if len(liquidatablePositions) == 0:
-        print("=================== NO LIQUIDATIONS DETECTED ==============================")
-        sys.exit()
-    
-    print(f"{len(liquidatablePositions)} positions open to liquidation")
-    for liquidatablePosition in liquidatablePositions:
+        logger.error("!!!!!! Failed to liquidate user: %s !!!!!!", liquidatablePosition.address)
+    except TimeExhausted:
+        logger.error("!!!!!! Liquidation of user %s not mined in time, resyncing the nonce !!!!!!", liquidatablePosition.address)
+        logger.error("TX hash: %s", txHash.hex())
+        # The transaction may have been dropped, leaving a gap every later nonce would wait behind
+        async with nonceTracker.lock:
+            nonceTracker.nonce = None
+        # Liquidating the position again while its transaction can still be mined would only revert
+        await wait_nonce_released(txHash, nonce)
+    except Exception:
+        logger.exception("!!!!!! Failed to get the receipt of the liquidation of user: %s !!!!!!", liquidatablePosition.address)
+    finally:
+        liquidationsInProgress.discard(liquidatablePosition.addressChecksum)
 
-        print("=================== NEW LIQUIDATION DETECTED ==============================")
 
-        # Filter only the liquidatablePosition that isCollateral is true
-        liquidatablePosition.supliedAssets = [asset for asset in liquidatablePosition.supliedAssets if asset.isCollateral == True]
-        # iterate over the different collaterals to liquidate
-        done = False
-        for c in liquidatablePosition.supliedAssets:
-            print("=================== NEW LIQUIDATION DETECTED ==============================")
+async def start_position_liquidation(liquidatablePosition, candidates, maxFeePerGas, maxPriorityFeePerGas):
+    # Simulates the candidates and broadcasts the first one that passes, returns the task following it until it is mined
+    simulatedCandidates = await simulate_position(liquidatablePosition, candidates)
+    if len(simulatedCandidates) == 0:
+        logger.info("No profitable liquidation for user: %s. Skipping", liquidatablePosition.address)
+        return None
 
-            print("collateral: \n", c)
+    txHash, nonce, remainingCandidates = await submit_position_liquidation(liquidatablePosition, simulatedCandidates, maxFeePerGas, maxPriorityFeePerGas)
+    if txHash is None:
+        logger.error("!!!!!! Failed to liquidate user: %s !!!!!!", liquidatablePosition.address)
+        return None
 
-            if float(c.fiatAmount) < 1:
-                # If the collateral is less than 1 USD, we skip it
-                print("Collateral is less than 1 USD. Skipping")
-                continue
-            if done:
-                # If we already liquidated a position, we break the loop
-                break
+    liquidationsInProgress.add(liquidatablePosition.addressChecksum)
+    return asyncio.create_task(
+        follow_position_liquidation(liquidatablePosition, txHash, nonce, remainingCandidates)
+    )
 
-            for b in liquidatablePosition.borrowedAssets:
-                # iterate over the different debts to repay
-                print("debt: \n", b)
-                
-                collateralAddress = Web3.to_checksum_address(c.contract)
-                debtAddress = Web3.to_checksum_address(b.contract)
 
-                print(f"Collateral fiat amount: {c.fiatAmount}")
-                print(f"Debt fiat amount: {b.variableRate.fiatAmount}")
+def viable_pairs(liquidatablePosition):
+    # (collateral, debt) pairs worth liquidating, sorted so the largest liquidatable USD value is tried first
+    pairs = [
+        (c, b)
+        for c in liquidatablePosition.supliedAssets
+        for b in liquidatablePosition.borrowedAssets
+        if c.fiatAmount >= 1 and b.variableRate.fiatAmount > 0 and b.variableRate.totalBorrowedAmount > 0
+    ]
+    return sorted(pairs, key=lambda pair: min(pair[0].fiatAmount, pair[1].variableRate.fiatAmount), reverse=True)
 
-                liquidationProtocolFee = lendingPoolContract.functions.liquidationProtocolFeePercentage().call() / 100
-                print(f"Liquidation protocol fee: {liquidationProtocolFee}%")
 
-                liquidationBonus = dataProviderContract.functions.getReserveConfigurationData(collateralAddress).call()[3] / 100 - 100
-                print(f"Liquidation bonus: {liquidationBonus}")
+def evaluate_position(liquidatablePosition, pairs, liquidationScaleFactors):
+    # Returns the (collateralAddress, debtAddress, debtToCover) candidates of a position, in the order they should be tried
+    logger.info("=================== NEW LIQUIDATION DETECTED ==============================")
 
-                liquidationScaleFactor = 1 + liquidationBonus * (1 + liquidationProtocolFee / 100) / 100
-                print(f"Liquidation scale factor: {liquidationScaleFactor}")
+    candidates = []
+    # iterate over the collateral/debt pairs to liquidate
+    for c, b in pairs:
+        # Dumping the assets is expensive, only build the strings when they are going to be logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("collateral: \n%s", c)
+            logger.debug("debt: \n%s", b)
 
+        collateralAddress = c.contractChecksum
+        debtAddress = b.contractChecksum
+        liquidationScaleFactor = liquidationScaleFactors[collateralAddress]
 
-                if (float(b.variableRate.fiatAmount) * liquidationScaleFactor) < float(c.fiatAmount):
-                    print("Scaled Debt is less than collateral. We can liquidate full debt")
-                    debtToCover = int(b.variableRate.totalBorrowedAmount)
-                else:
-                    print("Scaled Debt is more than collateral. We can only liquidate the USD-equivalent of the collateral in debt tokens")
+        logger.info("Collateral fiat amount: %s", c.fiatAmount)
+        logger.info("Debt fiat amount: %s", b.variableRate.fiatAmount)
 
-                    dDecimals = w3.eth.contract(address=Web3.to_checksum_address(debtAddress), abi=genericABI).functions.decimals().call()
-                    oneDebtInUSD = float(b.variableRate.fiatAmount) / float(int(b.variableRate.totalBorrowedAmount) / pow(10, dDecimals))
-                    print(f"One debt token in USD: {oneDebtInUSD}")
+        if (b.variableRate.fiatAmount * liquidationScaleFactor) < c.fiatAmount:
+            logger.info("Scaled Debt is less than collateral. We can liquidate full debt")
+            debtToCover = b.variableRate.totalBorrowedAmount
+        else:
+            logger.info("Scaled Debt is more than collateral. We can only liquidate the USD-equivalent of the collateral in debt tokens")
 
-                    cDecimals = w3.eth.contract(address=Web3.to_checksum_address(collateralAddress), abi=genericABI).functions.decimals().call()
-                    oneCollateralInUSD = float(c.fiatAmount) / float(int(c.totalSuppliedAmount) / pow(10, cDecimals))
-                    print(f"One collateral token in USD: {oneCollateralInUSD}")
+            dDecimals = decimalsCache[debtAddress]
+            oneDebtInUSD = b.variableRate.fiatAmount * SCALES[dDecimals] / b.variableRate.totalBorrowedAmount
+            logger.info("One debt token in USD: %s", oneDebtInUSD)
 
-                    # debt To cover is the equivalent amount of debt tokens of the amount of collateral in USD
-                    debtToCover = float(c.fiatAmount) / oneDebtInUSD / liquidationScaleFactor
+            cDecimals = decimalsCache[collateralAddress]
+            oneCollateralInUSD = c.fiatAmount * SCALES[cDecimals] / c.totalSuppliedAmount
+            logger.info("One collateral token in USD: %s", oneCollateralInUSD)
 
-                    print(f"Debt to cover in tokens: {debtToCover}")
+            # debt To cover is the equivalent amount of debt tokens of the amount of collateral in USD
+            debtToCover = c.fiatAmount / oneDebtInUSD / liquidationScaleFactor
 
-                    # Apply a bit of margin to the debt to cover
-                    margin = 1.01
+            logger.info("Debt to cover in tokens: %s", debtToCover)
 
-                    debtToCover = int (int(debtToCover * pow(10, dDecimals)) * margin)
+            # Apply a bit of margin to the debt to cover
+            margin = Decimal('1.01')
 
-                    print(f"debtToCover sent to contract: {debtToCover}")
+            debtToCover = int(debtToCover * SCALES[dDecimals] * margin)
 
-                try:
-                    liquidate(
-                        collateralAddress = collateralAddress, 
-                        debtAddress = debtAddress,
-                        pk = LIQUIDATOR_WALLET_PRIVATE_KEY, 
-                        caller = LIQUIDATOR_WALLET_ADDRESS,
-                        walletToLiquidateAddress = liquidatablePosition.address,
-                        debtToCover = debtToCover,
-                    )
-                    print(f"Succesfully liquidated user: {liquidatablePosition.address}")
-                    # finish for loop
-                    done = True
-                    break
-                except Exception as e:
-                    print("!!!!!! Failed to liquidate user !!!!!!")
-                    print(e.message)
+            logger.info("debtToCover sent to contract: %s", debtToCover)
 
-    print("=================== FINISHED LIQUIDATION PROCESS ==========================")
+        candidates.append((collateralAddress, debtAddress, debtToCover))
 
+    return candidates
 
 
-if __name__ == "__main__":
-    trigger_logic()
+async def trigger_logic(blockNumber=None):
+    # Fetches, evaluates and submits the liquidations, returns the tasks waiting for them to be mined
+    if blockNumber is not None:
+        logger.info("=================== NEW BLOCK %d ==============================", blockNumber)
 
+    liquidatablePositions = [
+        liquidatablePosition for liquidatablePosition in await getLiquidatablePositions()
+        if liquidatablePosition.addressChecksum not in liquidationsInProgress
+    ]
+
+    if len(liquidatablePositions) == 0:
+        logger.info("=================== NO LIQUIDATIONS DETECTED ==============================")
+        return []
+    
+    logger.info("%d positions open to liquidation", len(liquidatablePositions))
+
+    # Discard the pairs that can't be liquidated before doing any on-chain work
+    positionsPairs = []
+    for liquidatablePosition in liquidatablePositions:
+        pairs = viable_pairs(liquidatablePosition)
+        if len(pairs) == 0:
+            logger.info("No collateral/debt pair worth liquidating for user: %s. Skipping", liquidatablePosition.address)
+            continue
+        positionsPairs.append((liquidatablePosition, pairs))
+
+    if len(positionsPairs) == 0:
+        logger.info("=================== NO LIQUIDATIONS DETECTED ==============================")
+        return []
+
+    liquidatablePositions = [liquidatablePosition for liquidatablePosition, _ in positionsPairs]
+    collateralAddresses = list(dict.fromkeys(c.contractChecksum for _, pairs in positionsPairs for c, _ in pairs))
+    debtAddresses = [b.contractChecksum for _, pairs in positionsPairs for _, b in pairs]
+    missingTokens = [address for address in dict.fromkeys(collateralAddresses + debtAddresses) if address not in decimalsCache]
+
+    # Read the protocol fee, the reserve configuration of every collateral and the unknown token decimals in a single RPC round-trip
+    results = await multicall(
+        [(lendingPoolContract, 'liquidationProtocolFeePercentage', [])]
+        + [(dataProviderContract, 'getReserveConfigurationData', [address]) for address in collateralAddresses]
+        + [(erc20(address), 'decimals', []) for address in missingTokens]
+    )
+    liquidationProtocolFee = Decimal(results[0]) / 100
+    reserveConfigurations = results[1:1 + len(collateralAddresses)]
+    decimalsCache.update(zip(missingTokens, results[1 + len(collateralAddresses):]))
+    logger.info("Liquidation protocol fee: %s%%", liquidationProtocolFee)
+
+    # The scale factor only depends on the collateral, compute it once for all the debts
+    liquidationScaleFactors = {}
+    for collateralAddress, reserveConfiguration in zip(collateralAddresses, reserveConfigurations):
+        liquidationBonus = Decimal(reserveConfiguration[3]) / 100 - 100
+        liquidationScaleFactors[collateralAddress] = 1 + liquidationBonus * (1 + liquidationProtocolFee / 100) / 100
+        logger.info("Collateral %s liquidation bonus: %s, scale factor: %s", collateralAddress, liquidationBonus, liquidationScaleFactors[collateralAddress])
+
+    # All the on-chain data is already fetched, evaluating positions is pure computation
+    positionsCandidates = [
+        evaluate_position(liquidatablePosition, pairs, liquidationScaleFactors)
+        for liquidatablePosition, pairs in positionsPairs
+    ]
+
+    # Gas fees are fetched once and reused by every liquidation of this run
+    maxFeePerGas, maxPriorityFeePerGas = await getGasFees()
+
+    # Broadcast the liquidations of all positions concurrently, without waiting for them to be mined
+    followTasks = await asyncio.gather(*(
+        start_position_liquidation(liquidatablePosition, candidates, maxFeePerGas, maxPriorityFeePerGas)
+        for liquidatablePosition, candidates in zip(liquidatablePositions, positionsCandidates)
+    ))
+    followTasks = [task for task in followTasks if task is not None]
+    logger.info("%d liquidations submitted", len(followTasks))
+    return followTasks
+
+
+async def run_once():
+    await asyncio.gather(*await trigger_logic())
+    logger.info("=================== FINISHED LIQUIDATION PROCESS ==========================")
+
+
+async def run_trigger_logic(blockNumber, followTasks):
+    try:
+        for task in await trigger_logic(blockNumber):
+            # Keep a reference to the receipt tasks, the event loop only holds weak ones
+            followTasks.add(task)
+            task.add_done_callback(followTasks.discard)
+    except Exception:
+        logger.exception("Liquidation process failed for block %d", blockNumber)
+
+
+async def watch_new_heads():
+    # Runs the liquidation logic once per new block. Only fetching, evaluating and submitting is skipped while a
+    # previous run is still doing it, waiting for receipts happens in background tasks and doesn't block new blocks
+    lastBlockNumber = -1
+    run = None
+    followTasks = set()
+    while True:
+        try:
+            async with AsyncWeb3.persistent_websocket(WebsocketProviderV2(WS_RPC)) as wsWeb3:
+                await wsWeb3.eth.subscribe('newHeads')
+                logger.info("Subscribed to new blocks on %s", WS_RPC)
+                async for response in wsWeb3.ws.process_subscriptions():
+                    blockNumber = response['result']['number']
+                    if isinstance(blockNumber, str):
+                        blockNumber = int(blockNumber, 16)
+
+                    if blockNumber <= lastBlockNumber or (run is not None and not run.done()):
+                        continue
+                    lastBlockNumber = blockNumber
+                    run = asyncio.create_task(run_trigger_logic(blockNumber, followTasks))
+        except Exception:
+            logger.exception("New blocks subscription failed")
+
+        logger.info("New blocks subscription closed, reconnecting in %d seconds", WS_RECONNECT_DELAY)
+        await asyncio.sleep(WS_RECONNECT_DELAY)
+
+
+if __name__ == "__main__":
+    if WS_RPC:
+        asyncio.run(watch_new_heads())
+    else:
+        asyncio.run(run_once())